@@ -13,8 +13,14 @@ import sys
 import re
 import getopt
 import shutil
+import subprocess
 import registry_dict
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 if not shutil.which("fdisk"):
     raise RuntimeError("You need fdisk installed")
@@ -24,40 +30,52 @@ if os.geteuid() != 0:
 
 # Globals
 PartUUIDs = {}
+PartByDev = {}
 DiskUUIDs = {}
 PartDisks = {}
 PartDskNm = {}
 PartDescr = {}
 DiskOutput = {}
+_AllDiskUUIDs = {}
+_fdisk_loaded = False
+_UUID_RE = re.compile(r'^[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}$')
 
 
 def multiws_split(stg):
     "Split string fields delimited with multiple whitespace"
-    el = []
-    ln = len(stg)
-    previx = 0
-    ix = stg.find(' ', previx)
-    if ix == -1:
-        ix = stg.find('\t', previx)
-    while ix != -1:
-        el.append(stg[previx:ix])
-        previx = ix+1
-        while ln > previx and stg[previx].isspace():
-            previx += 1
-        ix = stg.find(' ', previx)
-        if ix == -1:
-            ix = stg.find('\t', previx)
-    if previx < ln:
-        el.append(stg[previx:])
-    return el
+    return stg.split()
+
+
+def load_all_fdisk():
+    "Use a single fdisk -l run to fill _AllDiskUUIDs and DiskOutput for all disks"
+    global _fdisk_loaded
+    if _fdisk_loaded:
+        return
+    _fdisk_loaded = True
+    out = subprocess.run(("fdisk", "-l"), capture_output=True, text=True,
+                         check=False).stdout
+    disk = None
+    for ln in out.splitlines():
+        if ln[:10] == "Disk /dev/":
+            disk = ln[10:ln.index(':')]
+            _AllDiskUUIDs[disk] = None
+            continue
+        if ln[:17] == "Disk identifier: " and disk:
+            _AllDiskUUIDs[disk] = ln[17:].lower()
+            continue
+        if ln[:5] != "/dev/":
+            continue
+        arr = multiws_split(ln)
+        DiskOutput[arr[0][5:]] = f"{arr[4]:6} " + " ".join(arr[5:])
 
 
 def disk_uuid(disk):
-    "Use fdisk to get DISK UUID"
+    "Use fdisk to get DISK UUID (fallback for disks missed by load_all_fdisk)"
     # global DiskOutput
     uuid = None
-    for ln in os.popen(f"fdisk -l /dev/{disk}"):
-        ln = ln.rstrip('\n')
+    out = subprocess.run(("fdisk", "-l", f"/dev/{disk}"), capture_output=True,
+                         text=True, check=False).stdout
+    for ln in out.splitlines():
         if ln[:17] == "Disk identifier: ":
             uuid = ln[17:].lower()
         if not ln.startswith(f"/dev/{disk}"):
@@ -67,26 +85,36 @@ def disk_uuid(disk):
     return uuid
 
 
+_loop_map = None
+
+
+def _build_loop_map():
+    "Map dm- names to their loop devices from one /dev/mapper scan"
+    lmap = {}
+    with os.scandir("/dev/mapper") as mdir:
+        for entry in mdir:
+            if entry.name.startswith("loop"):
+                lmap[os.readlink(entry.path).rsplit('/', 1)[-1]] = entry.name
+    return lmap
+
+
 def find_loop(nm):
     "Find whole disk loop device for dm- partitions (kpartx)"
-    loops = filter(lambda x: x.startswith("loop"), os.listdir("/dev/mapper"))
-    for lp in loops:
-        if os.path.basename(os.readlink(f"/dev/mapper/{lp}")) == nm:
-            return lp
-    return None
+    global _loop_map
+    if _loop_map is None:
+        _loop_map = _build_loop_map()
+    return _loop_map.get(nm)
 
 
 def strip_part(nm):
     "Find whole disk name by stripping partition suffix"
-    if not nm[-1].isdigit():
+    if not nm[-1:].isdigit():
         return None
     if nm[:2] == "dm":
         nm = find_loop(nm)
         if not nm:
             return None
-    dnm = nm[:-1]
-    while dnm[-1].isdigit():
-        dnm = dnm[:-1]
+    dnm = nm.rstrip('0123456789')
     if dnm[-1] == 'p':
         dnm = dnm[:-1]
     return dnm
@@ -95,6 +123,7 @@ def strip_part(nm):
 def collect_partuuids():
     """Create dicts by looking at part_uuid_path:
     * PartUUIDs has all Partition UUIDs with device names
+    * PartByDev is the reverse mapping from device names to Partition UUIDs
     * PartDisks holds Disk UUID belonging to Partition UUIDs
     * PartDskNm holds Disk DevName belonging to Partition UUIDs
     * PartDescr holds descriptions from fdisk -l
@@ -103,16 +132,21 @@ def collect_partuuids():
     """
     part_uuid_path = "/dev/disk/by-partuuid/"
     # global PartUUIDs, DiskUUIDs, PartDisks, PartDskNm, PartDescr
+    load_all_fdisk()
     with os.scandir(part_uuid_path) as pdir:
         for entry in pdir:
             if entry.name.startswith('.') or not entry.is_symlink():
                 continue
             part = os.path.basename(os.readlink(entry))
             PartUUIDs[entry.name] = part
+            PartByDev[part] = entry.name
             disknm = strip_part(part)
             if disknm:
                 if disknm not in DiskUUIDs:
-                    DiskUUIDs[disknm] = disk_uuid(disknm)
+                    if disknm in _AllDiskUUIDs:
+                        DiskUUIDs[disknm] = _AllDiskUUIDs[disknm]
+                    else:
+                        DiskUUIDs[disknm] = disk_uuid(disknm)
                 PartDisks[entry.name] = DiskUUIDs[disknm]
                 PartDskNm[entry.name] = disknm
                 if part in DiskOutput:
@@ -121,23 +155,19 @@ def collect_partuuids():
                     PartDescr[entry.name] = ""
 
 
+_ASCII_TABLE = bytes(1 if 32 <= b <= 122 else 0 for b in range(256))
+
+
 def counts(arr):
     "Count zeros and ASCII chars in byte array"
-    cntz = 0
-    cnta = 0
-    for val in arr:
-        if val == 0:
-            cntz += 1
-        if 32 <= val <= 122:
-            cnta += 1
-    return (cntz, cnta)
+    return (arr.count(0), arr.translate(_ASCII_TABLE).count(1))
 
 
 def uuidstr(hex16):
     "Create UUID string from byte array"
-    return f"{hex16[3]:02x}{hex16[2]:02x}{hex16[1]:02x}{hex16[0]:02x}-{hex16[5]:02x}{hex16[4]:02x}-" \
-           f"{hex16[7]:02x}{hex16[6]:02x}-{hex16[8]:02x}{hex16[9]:02x}-" \
-           f"{hex16[10]:02x}{hex16[11]:02x}{hex16[12]:02x}{hex16[13]:02x}{hex16[14]:02x}{hex16[15]:02x}"
+    h = bytes(hex16).hex()
+    return f"{h[6:8]}{h[4:6]}{h[2:4]}{h[0:2]}-{h[10:12]}{h[8:10]}-" \
+           f"{h[14:16]}{h[12:14]}-{h[16:20]}-{h[20:32]}"
 
 
 def find_part_disk(hexstr):
@@ -146,13 +176,23 @@ def find_part_disk(hexstr):
     offs = []
     hexarr = registry_dict.arr_from_hexstr(hexstr)
     ln = len(hexarr)
+    cntz_all = cnta_all = None
+    if np is not None and ln >= 48:
+        # Count zeros/ASCII chars for all 16-byte windows in one pass
+        wins = np.lib.stride_tricks.sliding_window_view(
+            np.frombuffer(hexarr, dtype=np.uint8), 16)
+        cntz_all = (wins == 0).sum(axis=1)
+        cnta_all = ((wins >= 32) & (wins <= 122)).sum(axis=1)
     idx = 32
     while ln >= idx+16:
         while hexarr[idx] == 0:
             idx += 4
         if ln < idx+16:
             return (ids, offs)
-        cntz, cnta = counts(hexarr[idx:idx+16])
+        if cntz_all is not None:
+            cntz, cnta = cntz_all[idx], cnta_all[idx]
+        else:
+            cntz, cnta = counts(hexarr[idx:idx+16])
         if cntz < 2 and cnta <= 10 and (ln == idx+16 or hexarr[idx+16] == 0):
             ids.append(uuidstr(hexarr[idx:idx+16]))
             offs.append(idx)
@@ -170,8 +210,7 @@ def partkey(st):
 
 def is_uuidfmt(st):
     "Returns true if string is in UUID format"
-    uuidfmt = re.compile(r'^[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}$')
-    return uuidfmt.match(st) is not None
+    return _UUID_RE.match(st) is not None
 
 
 def select_uuid():
@@ -193,16 +232,20 @@ def select_uuid():
             if is_uuidfmt(pid) and is_uuidfmt(did):
                 PartDisks[pid] = did
                 return pid
-        for partid, partnm in PartUUIDs.items():
-            if ans == partnm:
-                return partid
+        partid = PartByDev.get(ans)
+        if partid:
+            return partid
+
+
+# Byte order in which a UUID string is stored in the registry
+_UUID_SLICES = ((6, 8), (4, 6), (2, 4), (0, 2), (11, 13), (9, 11),
+                (16, 18), (14, 16), (19, 21), (21, 23),
+                (24, 26), (26, 28), (28, 30), (30, 32), (32, 34), (34, 36))
 
 
 def uuid_bytes(ustr):
     "Return reg dump file from bytes representing a UUID"
-    return f"{ustr[6:8]},{ustr[4:6]},{ustr[2:4]},{ustr[0:2]},{ustr[11:13]},{ustr[9:11]}," \
-           f"{ustr[16:18]},{ustr[14:16]},{ustr[19:21]},{ustr[21:23]}," \
-           f"{ustr[24:26]},{ustr[26:28]},{ustr[28:30]},{ustr[30:32]},{ustr[32:34]},{ustr[34:36]}"
+    return ",".join(ustr[a:b] for (a, b) in _UUID_SLICES)
 
 
 def correct_uuid(uuid, offs, dct):
@@ -226,22 +269,30 @@ def list_and_correct_entries(regd, ovwr_list):
 
     unfixed = 0
     fixes = 0
+    part_uuids = PartUUIDs
+    part_disks = PartDisks
+    part_dsknm = PartDskNm
+    uuid_keys = ((disk_key, "Disk "), (osdk_key, "OSDsk"))
     objs = regd["Objects"]
     for obk, ob in objs.items():
         elms = ob["Elements"]
-        if desc_key not in elms or 'Element' not in elms[desc_key]:
+        desc_elm = elms.get(desc_key)
+        if desc_elm is None or 'Element' not in desc_elm:
             continue
-        desc = elms[desc_key]["Element"]
+        desc = desc_elm["Element"]
         # TODO: We could actually search partitions for the files referenced here
-        if file_key in elms and 'Element' in elms[file_key]:
-            desc += " (" + elms[file_key]['Element'].replace("\\\\", "\\") + ")"
-        if fil2_key in elms and 'Element' in elms[fil2_key]:
-            desc += " (" + elms[fil2_key]['Element'].replace("\\\\", "\\") + ")"
+        file_elm = elms.get(file_key)
+        if file_elm is not None and 'Element' in file_elm:
+            desc += " (" + file_elm['Element'].replace("\\\\", "\\") + ")"
+        fil2_elm = elms.get(fil2_key)
+        if fil2_elm is not None and 'Element' in fil2_elm:
+            desc += " (" + fil2_elm['Element'].replace("\\\\", "\\") + ")"
         print(f"Entry {obk}: {desc}")
         resp = None
-        for key, txt in (disk_key, "Disk "), (osdk_key, "OSDsk"):
-            if key in elms:
-                ids, offs = find_part_disk(elms[key]['Element'])
+        for key, txt in uuid_keys:
+            elm = elms.get(key)
+            if elm is not None:
+                ids, offs = find_part_disk(elm['Element'])
                 print(f" {txt} IDs: {ids}")
                 if len(ids) != 2:
                     print("  ERROR")
@@ -250,31 +301,31 @@ def list_and_correct_entries(regd, ovwr_list):
                 obk2 = obk
                 if obk2[0] == '{' and obk2[-1] == '}':
                     obk2 = obk[1:-1]
-                if ids[0] not in PartUUIDs or obk in ovwr_list or obk2 in ovwr_list:
+                if ids[0] not in part_uuids or obk in ovwr_list or obk2 in ovwr_list:
                     print("  Partition UUID needs fixing!")
                     if not resp:
                         resp = select_uuid()
                     if not resp:
                         unfixed += 1
                         continue
-                    correct_uuid(resp, offs[0], elms[key])
-                    correct_uuid(PartDisks[resp], offs[1], elms[key])
+                    correct_uuid(resp, offs[0], elm)
+                    correct_uuid(part_disks[resp], offs[1], elm)
                     fixes += 2
                     # Validate
-                    ids, offs = find_part_disk(elms[key]['Element'])
+                    ids, offs = find_part_disk(elm['Element'])
                     assert ids[0] == resp
-                    assert ids[1] == PartDisks[resp]
+                    assert ids[1] == part_disks[resp]
                 else:
-                    if ids[0] not in PartDisks or not PartDisks[ids[0]]:
+                    if ids[0] not in part_disks or not part_disks[ids[0]]:
                         print(f"  Partition {ids[0]} without known disk")
                         unfixed += 1
                         continue
-                    if ids[1] != PartDisks[ids[0]]:
-                        print(f"  Partition {PartUUIDs[ids[0]]} should be on {PartDisks[ids[0]]} not {ids[1]}, correct")
-                        correct_uuid(PartDisks[ids[0]], offs[1], elms[key])
+                    if ids[1] != part_disks[ids[0]]:
+                        print(f"  Partition {part_uuids[ids[0]]} should be on {part_disks[ids[0]]} not {ids[1]}, correct")
+                        correct_uuid(part_disks[ids[0]], offs[1], elm)
                         fixes += 1
                     else:
-                        print(f"  Partition {PartUUIDs[ids[0]]} on {PartDskNm[ids[0]]} OK")
+                        print(f"  Partition {part_uuids[ids[0]]} on {part_dsknm[ids[0]]} OK")
     return fixes, unfixed
 
 
@@ -15,6 +15,7 @@
 
 import os
 import sys
+import copy
 import subprocess
 import tempfile
 import shutil
@@ -24,6 +25,11 @@ if not shutil.which("reged"):
     raise RuntimeError("You need reged (chntpw) installed")
 
 
+# Parsed dumps keyed by (regname, prefix, mtime), to skip the reged fork
+# when the same unchanged registry is read again.
+_REG_CACHE = {}
+
+
 def dump_reg(bcdnm, prefix="\\"):
     "Read BCD registry into a temporary text file (which is returned"
     tmp = tempfile.mkstemp()[1]
@@ -49,36 +55,40 @@ def add_to_dict(dct, key):
     """
     subdct = dct
     for k in key.split('\\'):
-        if k in subdct:
-            subdct = subdct[k]
-            # print(f"Chose existing subdct {k}")
-        else:
-            subdct[k] = {}
-            subdct = subdct[k]
-            # print(f"New empty subdct {k}")
+        subdct = subdct.setdefault(k, {})
     return subdct
 
 
-def reg_to_dict(tmpnm):
-    "Read dumped registry file and transform into python dictionary"
+def reg_to_dict(tmpnm, target=None):
+    """Read dumped registry file and transform into python dictionary
+       Parses into target if given (avoids copying the tree afterwards)
+    """
     header = None
-    regdict = {}
+    regdict = {} if target is None else target
     key = None
     elem = None
-    for ln in open(tmpnm, "r", encoding='utf-8'):
-        if ln[0] != "[" and key is None:
-            if not header:
-                header = ln.rstrip('\n')
-            continue
-        ln = ln.rstrip("\n")
+    cont = None
+    with open(tmpnm, "r", encoding='utf-8') as fh:
+        data = fh.read()
+    for ln in data.splitlines():
         # print(f"Parsing: \"{ln}\"")
         # New branch
         if not ln:
+            if cont:
+                key[elem] = ''.join(cont)
+                cont = None
             key = None
             elem = None
             continue
-        if ln[0] == "[":
-            assert ln[-1] == "]"
+        first = ln[0]
+        if first != "[" and key is None:
+            if not header:
+                header = ln
+            continue
+        if first == "[":
+            if cont:
+                key[elem] = ''.join(cont)
+                cont = None
             ln = ln[1:-1]
             if ln == "\\":
                 continue
@@ -87,68 +97,72 @@ def reg_to_dict(tmpnm):
             key = add_to_dict(regdict, ln)
             continue
         # New leaf
-        if ln[0] == '"':
-            assert key is not None
+        if first == '"':
+            if cont:
+                key[elem] = ''.join(cont)
             (k, val) = ln.split('=')
             if val[-1] == "\\":
                 val = val[:-1]
             k = k.replace('"', '')
-            key[k] = val
             elem = k
+            cont = [val]
             continue
         # Continuation
-        if ln[:2] == "  ":
-            assert elem
+        if ln.startswith("  "):
             ln = ln[2:]
             if ln[-1] == "\\":
                 ln = ln[:-1]
-            key[elem] += ln
+            cont.append(ln)
+    if cont:
+        key[elem] = ''.join(cont)
     return (regdict, header)
 
 
 def arr_from_hexstr(hexstr):
-    "Create array from hex data field in registry"
+    "Create byte array from hex data field in registry"
     if hexstr[:7] == "hex(7):":
         hexstr = hexstr[7:]
     elif hexstr[:4] == "hex:":
         hexstr = hexstr[4:]
     else:
         raise ValueError(hexstr)
-    return [int(x, 16) for x in hexstr.split(",")]
+    return bytes.fromhex(hexstr.replace(",", ""))
 
 
-def output_elem(val, f):
-    "write leaf element into reg dump file"
+def output_elem(val, chunks):
+    "append leaf element lines to reg dump output chunks"
     wrap = 66
     while val:
         if len(val) <= wrap:
-            print(val, file=f)
+            chunks.append(val + "\n")
             return
         idx = val.find(",", wrap-2)
         wrap = 76
-        print(val[:idx+1] + "\\\n  ", file=f, end='')
+        chunks.append(val[:idx+1] + "\\\n  ")
         val = val[idx+1:]
 
 
-def output_regsub(regd, f, pre):
-    "write sub dict into reg dump file"
+def output_regsub(regd, chunks, pre):
+    "append sub dict reg dump lines to output chunks"
     for key in regd.keys():
         if isinstance(regd[key], dict):
-            print(f"\n[{pre}\\{key}]", file=f)
-            output_regsub(regd[key], f, pre+"\\"+key)
+            chunks.append(f"\n[{pre}\\{key}]\n")
+            output_regsub(regd[key], chunks, pre+"\\"+key)
         else:
-            print(f"\"{key}\"=", file=f, end='')
-            output_elem(regd[key], f)
+            chunks.append(f"\"{key}\"=")
+            output_elem(regd[key], chunks)
 
 
 def output_reg(regd, fnm, header):
     "write dict into reg dump file"
+    chunks = []
+    if header:
+        chunks.append(header + "\n\n")
+    chunks.append("[\\]\n")
+    output_regsub(regd, chunks, "\\")
+    chunks.append("\n")
     with open(fnm, "w", newline = "\r\n", encoding='utf-8') as f:
-        if header:
-            print(header + "\n", file=f)
-        print("[\\]", file=f)
-        output_regsub(regd, f, "\\")
-        print('', file=f)
+        f.write(''.join(chunks))
 
 
 class RegDict(dict):
@@ -160,7 +174,6 @@ class RegDict(dict):
         self.regname = regname
         self.prefix = prefix
         self.header = None
-        super().__init__()
         self.read()
 
     def read(self, nm=None, pre=None):
@@ -169,10 +182,21 @@ class RegDict(dict):
             self.regname = nm
         if pre:
             self.prefix = pre
-        tmpnm = dump_reg(self.regname, self.prefix)
-        dct, self.header = reg_to_dict(tmpnm)
-        super().__init__(dct)
-        os.remove(tmpnm)
+        ck = (self.regname, self.prefix, os.stat(self.regname).st_mtime_ns)
+        if ck in _REG_CACHE:
+            dct, self.header = copy.deepcopy(_REG_CACHE[ck])
+            super().__init__(dct)
+        else:
+            tmpnm = dump_reg(self.regname, self.prefix)
+            if self:
+                # Re-read on a filled instance: parse into a fresh dict so
+                # the merged contents cannot end up in the cache
+                dct, self.header = reg_to_dict(tmpnm)
+                super().__init__(dct)
+            else:
+                _, self.header = reg_to_dict(tmpnm, self)
+                _REG_CACHE[ck] = copy.deepcopy((dict(self), self.header))
+            os.remove(tmpnm)
         return self
 
     def write(self, backup=False):
@@ -183,6 +207,8 @@ class RegDict(dict):
         output_reg(self, tmpnm, self.header)
         ret = write_reg(self.regname, tmpnm, self.prefix)
         os.remove(tmpnm)
+        for ck in [ck for ck in _REG_CACHE if ck[0] == self.regname]:
+            del _REG_CACHE[ck]
         return ret
 
     def __repr__(self):